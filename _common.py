@@ -0,0 +1,25 @@
+# Code shared by the thread-based and the coroutine-based cache.
+import msgspec, time, sys
+from typing import Tuple
+
+
+# The last formatted timestamp, as (seconds, string). It is replaced as a
+# whole, so concurrent loggers at worst format the same second twice.
+_log_time: Tuple[int, str] = (0, "")
+
+def log(msg: str):
+    global _log_time
+    s = int(time.time())
+    last = _log_time
+    if s != last[0]:
+        last = _log_time = (s, time.strftime("%T", time.localtime(s)))
+    print(f"[{last[1]}]: {msg}", file=sys.stderr)
+
+
+BASE_URL = "http://localhost:8080/item/"
+
+
+class ItemPayload(msgspec.Struct):
+    """An item, as sent by the origin server."""
+    content: str
+    expires_in: int
@@ -1,15 +1,29 @@
 #!/usr/bin/env python3
+if __name__ == "__main__":
+    # Hand off to hypercorn
+    import os, shutil
+    here = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(here) # The only simple way to be able to execute this from anywhere.
+    # `_common` (shared with the thread-based version) lives one directory up.
+    # It's importable only via PYTHONPATH, so we hand off before the imports below.
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(here), env.get("PYTHONPATH")]))
+    executable = shutil.which("hypercorn")
+    assert executable is not None, "No hypercorn in PATH!"
+    os.execve(executable, ["ignored", "--worker-class=trio", "--bind=0.0.0.0:1234", "cache:app"], env)
+
 import quart
 from quart_trio import QuartTrio
-import asks, trio, time, sys
+import httpx, trio, orjson, msgspec, random, heapq, math
 from typing import List, Dict, Set, Tuple, Optional, Any, Iterable
+from _common import log, BASE_URL, ItemPayload
 
 
 # Overview
 # --------
-# This is a straightforward translation of the thread-based version. We have:
+# This started as a straightforward translation of the thread-based version. We have:
 #   * a token dict
-#   * a coroutine per dict entry, keeping it fresh
+#   * a scheduler coroutine, starting a refresh whenever an entry is nearly stale
 #   * a coroutine (framework HTTP handler) serving entries from the dict
 #
 # Instead of threads, we have coroutines, which makes it more efficient.
@@ -17,26 +31,27 @@ from typing import List, Dict, Set, Tuple, Optional, Any, Iterable
 # loop on its own thread.
 
 
-def log(msg: str):
-    now = time.strftime("%T")
-    print(f"[{now}]: {msg}", file=sys.stderr)
-
-
-BASE_URL = "http://localhost:8080/item/"
-
-
 class CacheEntry:
-    def __init__(self, token: str, expires_in: int):
+    __slots__ = ("token", "ttl", "issued_at", "expires_at", "grace_period", "body_prefix")
+
+    def __init__(self, token: str, expires_in: int, grace_period: float = 60):
         now = trio.current_time()
 
         self.token: str = token
         self.ttl: int = expires_in
         self.issued_at: float = now
         self.expires_at: float = now + expires_in
+        # How long past `expires_at` we still serve the entry, if we can't refresh it.
+        self.grace_period: float = grace_period
+        # Only `expires_in` changes between requests, so we serialize
+        # everything before it once, instead of on every request.
+        self.body_prefix: bytes = b'{"content":' + orjson.dumps(token) + b',"expires_in":'
 
 
 async def fetch_item(
         server_name: str,
+        client: httpx.AsyncClient,
+        limiter: trio.CapacityLimiter,
         timeout: float = 10,
         base_retry_interval: float = 0.1,
         max_retry_interval: float = 3600,
@@ -44,63 +59,72 @@ async def fetch_item(
     """Fetch an item from an origin server, with infinite retries and exponential backoff."""
 
     i = 0
+    delay = base_retry_interval
     while True:
 
         if i != 0:
-            # Exponential backoff for retries
-            await trio.sleep(min(base_retry_interval * 2**(i-1), max_retry_interval))
+            # Exponential backoff for retries, with decorrelated jitter,
+            # so that refreshers which failed together don't retry together.
+            delay = min(max_retry_interval, random.uniform(base_retry_interval, delay * 3))
+            await trio.sleep(delay)
 
         try:
-            resp = await asks.get(f"{BASE_URL}{server_name}", timeout=timeout)
+            # Only the request itself counts against the limit, not the backoff.
+            async with limiter:
+                resp = await client.get(f"{BASE_URL}{server_name}", timeout=timeout)
             if resp.status_code == 200:
-                token = resp.json()
-                assert type(token.get("content")) is str, "Malformed token content!"
-                assert type(token.get("expires_in")) is int, "Missing or malformed TTL field!"
-                entry = CacheEntry(token["content"], token["expires_in"])
+                payload = msgspec.json.decode(resp.content, type=ItemPayload)
+                entry = CacheEntry(payload.content, payload.expires_in)
 
                 # All is OK, we have a fresh token.
                 log(f"Got token for {server_name}, expires in {entry.ttl}s")
                 return entry
 
-        except asks.errors.RequestTimeout as e:
+        except msgspec.DecodeError as e:
+            # Malformed token, or missing or malformed TTL field.
+            log(f"Bad token for {server_name}: {e}")
+
+        except httpx.TimeoutException as e:
             pass
 
-        except (asks.errors.ConnectivityError, OSError) as e:
+        except (httpx.TransportError, OSError) as e:
             # Try again -- by proceeding to next loop iteration.
             pass
 
         i += 1
 
 
-async def keep_single_item_fresh(d: Dict[str, Optional[CacheEntry]], name: str, cancel_scope: trio.CancelScope) -> None:
-    """
-    Keeps a single item fresh; never returns.
-    """
-    with cancel_scope:
-        # First, we ensure that the entry is present.
-        if d[name] is None:
-            d[name] = await fetch_item(name)
-
-        # Then we just keep it fresh:
-        # sleep until it's 90% expired, then refetch it.
-        while True:
-            entry = d[name]
-            assert entry is not None  # mypy demands that we be sure of it
-            await trio.sleep_until(entry.issued_at + 0.90 * entry.ttl)
-            d[name] = await fetch_item(name)
-
-
 class ProactiveCache:
     """
     A cache of always-fresh entries.
 
+    A single scheduler coroutine keeps a heap of (refresh_at, name) pairs and
+    sleeps until the earliest one is due. Only refreshes which are actually
+    in flight get a coroutine of their own.
+
+    All of these run in the nursery passed in, so the cache stops refreshing
+    when that nursery exits. Use `aclose()` to stop it earlier.
+
     Not thread-safe! Don't touch it from more than one thread at the same time.
     """
 
-    def __init__(self, nursery: trio.Nursery, resource_names: Iterable[str] = ()):
+    def __init__(
+            self,
+            nursery: trio.Nursery,
+            client: httpx.AsyncClient,
+            resource_names: Iterable[str] = (),
+            max_concurrent_refreshes: int = 8,
+        ):
         self.nursery = nursery
+        self.client = client
+        self._limiter = trio.CapacityLimiter(max_concurrent_refreshes)
         self._entries: Dict[str, Optional[CacheEntry]] = {}
-        self._cancel_scopes: Dict[str, trio.CancelScope] = {}
+        self._cancel_scopes: Dict[str, trio.CancelScope] = {}  # of in-flight refreshes
+        self._heap: List[Tuple[float, str]] = []
+        self._refresh_at: Dict[str, float] = {}  # heap items not listed here are stale
+        self._wakeup = trio.Event()
+        self._scheduler_cancel_scope = trio.CancelScope()
+        self.nursery.start_soon(self._schedule_refreshes)
         for name in resource_names:
             self.add_resource(name)
 
@@ -109,31 +133,88 @@ class ProactiveCache:
         Add a new resource to the cache, if not already present.
         """
         if resource_name not in self._entries:
-            cancel_scope = trio.CancelScope()
             self._entries[resource_name] = None
-            self._cancel_scopes[resource_name] = cancel_scope
-            self.nursery.start_soon(keep_single_item_fresh, self._entries, resource_name, cancel_scope)
+            self._schedule(resource_name, 0.0)
 
     def remove_resource(self, resource_name: str) -> None:
         """
         Forget all about the resource.
         """
         if resource_name in self._entries:
-            self._cancel_scopes[resource_name].cancel()
-            del self._cancel_scopes[resource_name]
+            cancel_scope = self._cancel_scopes.pop(resource_name, None)
+            if cancel_scope is not None:
+                cancel_scope.cancel()
+            self._refresh_at.pop(resource_name, None)
             del self._entries[resource_name]
 
-    def __del__(self) -> None:
-        for name in self._entries:
-            self._cancel_scopes[name].cancel()
-        del self._cancel_scopes
-        del self._entries
+    async def aclose(self) -> None:
+        """
+        Stop refreshing all entries.
+        """
+        self._scheduler_cancel_scope.cancel()
+        for cancel_scope in self._cancel_scopes.values():
+            cancel_scope.cancel()
+
+    def _schedule(self, resource_name: str, refresh_at: float) -> None:
+        self._refresh_at[resource_name] = refresh_at
+        heapq.heappush(self._heap, (refresh_at, resource_name))
+        self._wakeup.set()
+
+    async def _schedule_refreshes(self) -> None:
+        """
+        Starts refreshes as they come due; returns only once cancelled.
+        """
+        with self._scheduler_cancel_scope:
+            while True:
+                deadline = self._heap[0][0] if self._heap else math.inf
+                with trio.move_on_at(deadline):
+                    await self._wakeup.wait()
+                self._wakeup = trio.Event()
+
+                now = trio.current_time()
+                while self._heap and self._heap[0][0] <= now:
+                    refresh_at, name = heapq.heappop(self._heap)
+                    if self._refresh_at.get(name) != refresh_at:
+                        continue  # removed or rescheduled since
+                    del self._refresh_at[name]
+                    cancel_scope = trio.CancelScope()
+                    self._cancel_scopes[name] = cancel_scope
+                    self.nursery.start_soon(self._refresh, name, cancel_scope)
+
+    async def _refresh(self, name: str, cancel_scope: trio.CancelScope) -> None:
+        """
+        Refetches a single item, and schedules its next refresh.
+        """
+        with cancel_scope:
+            entry = await fetch_item(name, self.client, self._limiter)
+        if self._cancel_scopes.get(name) is cancel_scope:
+            del self._cancel_scopes[name]
+        if cancel_scope.cancel_called:
+            return
+
+        # The old entry is served until the new one has arrived, and we
+        # refetch when it's 80% expired, so a slow refetch has the
+        # remaining 20% of the TTL before anyone notices.
+        self._entries[name] = entry
+        self._schedule(name, entry.issued_at + 0.80 * entry.ttl)
+
+    def get(self, resource_name: str, now: Optional[float] = None) -> Optional[Tuple[CacheEntry, float]]:
+        """
+        Returns the entry and its time left if it is present and not expired.
 
-    async def get(self, resource_name: str) -> Optional[CacheEntry]:
-        """Returns the entry if it is present and not expired"""
+        An expired entry is still returned during its grace period, with a
+        negative time left. This way an origin outage doesn't immediately
+        turn into misses.
+
+        Pass `now` if you have already read the clock; it defaults to `trio.current_time()`.
+        """
         entry = self._entries.get(resource_name, None)
-        if entry is not None and trio.current_time() <= entry.expires_at:
-            return entry
+        if entry is not None:
+            if now is None:
+                now = trio.current_time()
+            time_left = entry.expires_at - now
+            if time_left >= -entry.grace_period:
+                return entry, time_left
         return None
 
 
@@ -147,25 +228,32 @@ CACHE = None
 @app.before_serving
 async def initialize_cache():
     global CACHE
-    CACHE = ProactiveCache(app.nursery, ["alpha", "bravo", "charlie", "delta"])
+    # One client for all refreshers: connections are kept alive and reused,
+    # and the pool limits bound the number of sockets we open to the origin.
+    app.http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=8, max_connections=16),
+        timeout=10.0,
+    )
+    CACHE = ProactiveCache(app.nursery, app.http_client, ["alpha", "bravo", "charlie", "delta"])
+
+
+@app.after_serving
+async def close_cache():
+    await CACHE.aclose()
+    await app.http_client.aclose()
 
 
 @app.route("/item/<name>", methods=["GET"])
 async def handle_request(name):
-    try:
-        entry = await CACHE.get(name)
-        if entry is None:
-            raise KeyError
-        time_left = entry.expires_at - trio.current_time()
-        return {"content": entry.token, "expires_in": int(time_left)}
-    except KeyError:
+    now = trio.current_time()
+    hit = CACHE.get(name, now=now)
+    if hit is None:
         quart.abort(404)
-
-
-if __name__ == "__main__":
-    # Hand off to hypercorn
-    import os, shutil
-    os.chdir(os.path.dirname(__file__)) # The only simple way to be able to execute this from anywhere.
-    executable = shutil.which("hypercorn")
-    assert executable is not None, "No hypercorn in PATH!"
-    os.execve(executable, ["ignored", "--worker-class=trio", "--bind=0.0.0.0:1234", "cache:app"], os.environ)
+    entry, time_left = hit
+    if time_left >= 0:
+        body = entry.body_prefix + str(int(time_left)).encode() + b"}"
+        return quart.Response(body, content_type="application/json")
+    else:
+        # Past its TTL, but within its grace period.
+        body = entry.body_prefix + b"0}"
+        return quart.Response(body, content_type="application/json", headers={"X-Cache-Stale": "true"})
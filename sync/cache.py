@@ -1,16 +1,35 @@
 #!/usr/bin/env python3
-import flask, threading, time, requests, sys
-from typing import List, Dict, Optional, Union
+if __name__ == "__main__":
+    # Hand off to gunicorn
+    import os, shutil
+    here = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(here) # The only simple way to be able to execute this from anywhere.
+    # `_common` (shared with the coroutine-based version) lives one directory up.
+    # It's importable only via PYTHONPATH, so we hand off before the imports below.
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(here), env.get("PYTHONPATH")]))
+    executable = shutil.which("gunicorn")
+    assert executable is not None, "No gunicorn in PATH!"
+    os.execve(executable, ["ignored", "--bind=0.0.0.0:1234", "cache:app"], env)
 
-def log(msg: str):
-    now = time.strftime("%T")
-    print(f"[{now}]: {msg}", file=sys.stderr)
+import flask, threading, time, requests, orjson, msgspec, random
+from typing import List, Dict, Optional, Union, NamedTuple
+from _common import log, BASE_URL, ItemPayload
+
+# Shared by all updater threads, so connections to the origin get reused.
+SESSION = requests.Session()
+SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+# Caps the number of concurrent requests to the origin, e.g. when all
+# updaters start at once, or retry at once after an outage.
+MAX_CONCURRENT_REFRESHES = threading.Semaphore(8)
 
-BASE_URL = "http://localhost:8080/item/"
 
 class Item:
+    __slots__ = ("content", "ttl", "expires_at")
+
     def __init__(self, content: str, expires_in: int):
-        now = time.time()
+        now = time.monotonic()
         self.content: str = content
         self.ttl: int = expires_in
         self.expires_at: float = expires_in + now
@@ -25,22 +44,28 @@ def fetch_item(
     """Fetch an item from an origin server, with infinite retries and exponential backoff."""
 
     i = 0
+    delay = base_retry_interval
     while True:
 
         if i != 0:
-            # Exponential backoff for retries
-            time.sleep(min(base_retry_interval * 2**(i-1), max_retry_interval))
+            # Exponential backoff for retries, with decorrelated jitter,
+            # so that refreshers which failed together don't retry together.
+            delay = min(max_retry_interval, random.uniform(base_retry_interval, delay * 3))
+            time.sleep(delay)
 
         try:
-            resp = requests.get(f"{BASE_URL}{server_name}", timeout=timeout)
+            with MAX_CONCURRENT_REFRESHES:
+                resp = SESSION.get(f"{BASE_URL}{server_name}", timeout=timeout)
             if resp.ok:
-                token = resp.json()
-                assert type(token.get("content")) is str, "Malformed token content!"
-                assert type(token.get("expires_in")) is int, "Missing or malformed TTL field!"
+                payload = msgspec.json.decode(resp.content, type=ItemPayload)
 
                 # All is OK, we have a fresh token.
-                log(f"Got token for {server_name}, expires in {token['expires_in']}s")
-                return Item(content=token["content"], expires_in=token["expires_in"])
+                log(f"Got token for {server_name}, expires in {payload.expires_in}s")
+                return Item(content=payload.content, expires_in=payload.expires_in)
+
+        except msgspec.DecodeError as e:
+            # Malformed token, or missing or malformed TTL field.
+            log(f"Bad token for {server_name}: {e}")
 
         except requests.Timeout as e:
             pass
@@ -52,24 +77,35 @@ def fetch_item(
         i += 1
 
 
+class Snapshot(NamedTuple):
+    expires_at: float
+    # The serialized response, up to the `expires_in` value.
+    body_prefix: bytes
+
+
 class CacheEntry:
-    """A cache entry. Has a R/W lock, and a thread to keep it fresh."""
+    """
+    A cache entry, with a thread to keep it fresh.
+
+    The content is published as an immutable snapshot. The updater replaces
+    it with a single attribute store, so readers need no locking.
+    """
+    __slots__ = ("server_name", "snapshot", "updater")
+
     def __init__(self, server_name: str):
         self.server_name = server_name
-        self.lock = threading.Lock()
-        self.content: Optional[str] = None
-        self.expires_at: float = 0  # earlier than anything sensible
+        self.snapshot: Optional[Snapshot] = None
 
         def update(entry: CacheEntry):
             """Keep given cache entry forever fresh."""
             while True:
                 item = fetch_item(entry.server_name)
-                now = time.time()
-                with entry.lock:
-                    entry.content = item.content
-                    entry.expires_at = now + item.ttl
-                # Sleep until it's nearly stale.
-                t_sleep = 0.9 * item.ttl
+                now = time.monotonic()
+                body_prefix = b'{"content":' + orjson.dumps(item.content) + b',"expires_in":'
+                entry.snapshot = Snapshot(now + item.ttl, body_prefix)
+                # Sleep until it's nearly stale. The old content stays
+                # served while we refetch, so leave room for a slow origin.
+                t_sleep = 0.8 * item.ttl
                 log(f"[{self.server_name}]: sleeping for {t_sleep}")
                 time.sleep(t_sleep)
                 log(f"[{self.server_name}]: woke up")
@@ -84,13 +120,15 @@ class ProactiveCache:
         # The outer dictionary is not locked, and is effectively read-only.
         self._entries = {sname: CacheEntry(sname) for sname in server_names}
 
-    def get_token(self, server_name: str):
+    def get_body(self, server_name: str) -> Optional[bytes]:
+        """Returns the token, serialized to JSON, if it is present and not expired."""
         entry = self._entries.get(server_name, None)
         if entry is not None:
-            with entry.lock:
-                time_left = entry.expires_at - time.time()
+            snapshot = entry.snapshot
+            if snapshot is not None:
+                time_left = snapshot.expires_at - time.monotonic()
                 if time_left >= 0:
-                    return {"content": entry.content, "expires_in": int(time_left)}
+                    return snapshot.body_prefix + str(int(time_left)).encode() + b"}"
         return None
 
 
@@ -101,17 +139,8 @@ app = flask.Flask("proactive-cache-server")
 
 @app.route("/item/<name>", methods=["GET"])
 def handle_request(name):
-    token = CACHE.get_token(name)
-    if token is not None:
-        return flask.jsonify(token)
+    body = CACHE.get_body(name)
+    if body is not None:
+        return flask.Response(body, content_type="application/json")
     else:
         flask.abort(404)
-
-
-if __name__ == "__main__":
-    # Hand off to gunicorn
-    import os, shutil
-    os.chdir(os.path.dirname(__file__)) # The only simple way to be able to execute this from anywhere.
-    executable = shutil.which("gunicorn")
-    assert executable is not None, "No gunicorn in PATH!"
-    os.execve(executable, ["ignored", "--bind=0.0.0.0:1234", "cache:app"], os.environ)
@@ -1,21 +1,22 @@
 #!/usr/bin/env python3
 import flask
 
-SERVER_NAMES = ["alpha", "bravo", "charlie", "delta"]
+# Pre-serialized response bodies, by resource name.
+RESPONSES = {
+    "alpha": b'{"content":"alpha","expires_in":120}',
+    "bravo": b'{"content":"bravo","expires_in":120}',
+    "charlie": b'{"content":"Hi, charlie!","expires_in":30}',
+    "delta": b'{"content":"Delta David is the content","expires_in":200}',
+}
 BASE_URL = "http://localhost:8080/item/"
 app = flask.Flask("origin-server")
 
 @app.route("/item/<name>", methods=["GET"])
 def handle_request(name):
-    if name not in SERVER_NAMES:
+    body = RESPONSES.get(name)
+    if body is None:
         return flask.Response("Nonexistent resource", 404)
-
-    if name in ("alpha", "bravo"):
-        return {"content": name, "expires_in": 120}
-    elif name == "charlie":
-        return {"content": "Hi, charlie!", "expires_in": 30}
-    else:
-        return {"content": "Delta David is the content", "expires_in": 200}
+    return flask.Response(body, content_type="application/json")
 
 if __name__ == "__main__":
     # Hand off to gunicorn